@@ -21,36 +21,92 @@ Usage:
 
 Environment (optional, for non-interactive):
   DOMAIN=example.com LE_EMAIL=you@example.com python3 enable_https.py
+  RENEW_THRESHOLD_DAYS=30   (reuse an existing cert valid for at least this long)
 """
 
 import os
 import sys
 import subprocess
 import time
+import functools
+import types
+import re
+import shlex
+import collections
 from pathlib import Path
 import shutil
 
 
 def log(msg):
     ts = time.strftime("%Y-%m-%d %H:%M:%S")
-    print("%s %s" % (ts, msg))
+    print("%s %s" % (ts, msg), flush=True)
+
+
+def env_int(name, default):
+    """Non-negative integer from the environment; invalid values are logged and replaced by default."""
+    raw = os.environ.get(name, "").strip()
+    if not raw:
+        return default
+    try:
+        value = int(raw)
+    except ValueError:
+        value = -1
+    if value < 0:
+        log("Ignoring invalid %s=%r, using %d" % (name, raw, default))
+        return default
+    return value
+
+
+RENEW_THRESHOLD_DAYS = env_int("RENEW_THRESHOLD_DAYS", 30)
+
+
+# Commands containing any of these need /bin/sh (pipes, ||, $(...), redirects).
+SHELL_META = re.compile(r"[|&;<>()$`*?~]")
+
+
+def command_argv(cmd):
+    """Return an argv list for cmd, or None if it must go through the shell."""
+    if SHELL_META.search(cmd):
+        return None
+    try:
+        return shlex.split(cmd)
+    except ValueError:
+        # unbalanced quotes: let /bin/sh report it like it always did
+        return None
+
+
+def spawn(cmd, argv):
+    """Popen argv directly; names with no binary on PATH (shell builtins) fall back to /bin/sh."""
+    kwargs = dict(stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
+    if argv is not None:
+        try:
+            return subprocess.Popen(argv, **kwargs)
+        except FileNotFoundError:
+            pass
+    return subprocess.Popen(cmd, shell=True, **kwargs)
+
+
+def stream_command(cmd, emit):
+    """
+    Run cmd, passing each output line to emit() as it arrives.
+    Returns (returncode, last 200 lines of output).
+    """
+    argv = command_argv(cmd)
+    tail = collections.deque(maxlen=200)
+    p = spawn(cmd, argv)
+    with p.stdout:
+        for line in p.stdout:
+            emit(line.rstrip("\n"))
+            tail.append(line)
+    return p.wait(), "".join(tail)
 
 
 def run(cmd, check=True):
     log("> " + cmd)
-    res = subprocess.run(
-        cmd,
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True,
-    )
-    if res.stdout:
-        for line in res.stdout.splitlines():
-            print("  " + line)
-    if check and res.returncode != 0:
-        raise RuntimeError("Command failed (%s): %s\n%s" % (res.returncode, cmd, res.stdout))
-    return res
+    returncode, out = stream_command(cmd, lambda line: print("  " + line, flush=True))
+    if check and returncode != 0:
+        raise RuntimeError("Command failed (%s): %s\n%s" % (returncode, cmd, out))
+    return subprocess.CompletedProcess(cmd, returncode, stdout=out)
 
 
 def which(cmd):
@@ -58,19 +114,36 @@ def which(cmd):
     return _which(cmd)
 
 
+@functools.lru_cache(maxsize=1)
 def detect_os():
-    os_release = {}
+    """Parse /etc/os-release once per run; the result is read-only and shared."""
     p = Path("/etc/os-release")
-    if p.exists():
-        for ln in p.read_text().splitlines():
-            ln = ln.strip()
-            if "=" in ln:
-                k, v = ln.split("=", 1)
-                os_release[k] = v.strip().strip('"')
+    text = p.read_text() if p.exists() else ""
+    os_release = {
+        k.strip(): v.strip().strip('"')
+        for k, sep, v in (ln.partition("=") for ln in text.splitlines())
+        if sep and k.strip()
+    }
     distro = os_release.get("ID", "").lower()
     like = os_release.get("ID_LIKE", "").lower()
     version = os_release.get("VERSION_ID", "")
-    return {"distro": distro, "like": like, "version": version, "os_release": os_release}
+    return types.MappingProxyType(
+        {"distro": distro, "like": like, "version": version, "os_release": types.MappingProxyType(os_release)}
+    )
+
+
+APT_STAMP = Path("/var/lib/apt/periodic/update-success-stamp")
+
+
+def apt_update(max_age=3600):
+    """apt-get update, skipped when the package lists were refreshed within max_age seconds."""
+    try:
+        if time.time() - APT_STAMP.stat().st_mtime < max_age:
+            log("apt package lists are fresh, skipping apt-get update")
+            return
+    except OSError:
+        pass
+    run("sudo apt-get update -y", check=False)
 
 
 def ensure_certbot():
@@ -91,7 +164,7 @@ def ensure_certbot():
             elif which("yum"):
                 run("sudo yum install -y certbot", check=False)
         elif any(x in distro for x in ("ubuntu", "debian", "raspbian")):
-            run("sudo apt-get update -y", check=False)
+            apt_update()
             run("sudo apt-get install -y certbot", check=False)
         else:
             # generic fallback
@@ -100,7 +173,7 @@ def ensure_certbot():
             elif which("yum"):
                 run("sudo yum install -y certbot", check=False)
             elif which("apt-get"):
-                run("sudo apt-get update -y", check=False)
+                apt_update()
                 run("sudo apt-get install -y certbot", check=False)
     except Exception as e:
         log("Error while trying to install certbot: %s" % e)
@@ -135,12 +208,39 @@ def raw_input_py3(prompt):
         return ""
 
 
+def cert_still_valid(domain, days=RENEW_THRESHOLD_DAYS):
+    """
+    True if /etc/letsencrypt/live/<domain>/fullchain.pem exists and does not
+    expire within `days` days. Uses `openssl x509 -checkend` (one process,
+    no extra Python deps); renewal is left to certbot's own timer.
+    """
+    cert = Path("/etc/letsencrypt/live") / domain / "fullchain.pem"
+    # /etc/letsencrypt/live is root-only (0700), so a plain cert.exists() would
+    # report False for non-root users. openssl runs under sudo and exits non-zero
+    # for a missing file, which doubles as the existence check.
+    try:
+        res = subprocess.run(
+            ["sudo", "openssl", "x509", "-checkend", str(days * 86400), "-noout", "-in", str(cert)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+    except OSError:
+        return False
+    return res.returncode == 0
+
+
 def obtain_certificate(domain, email):
     """
     Stop nginx container, run certbot standalone to get cert for:
       - domain
       - www.domain
+    Skipped entirely when the existing cert does not expire within RENEW_THRESHOLD_DAYS days.
     """
+    cert_dir = Path("/etc/letsencrypt/live") / domain
+    if cert_still_valid(domain):
+        log("Existing certificate for %s does not expire within %d days, skipping certbot." % (domain, RENEW_THRESHOLD_DAYS))
+        return str(cert_dir)
+
     log("Stopping nginx container (to free port 80 for certbot standalone)...")
     run("sudo docker-compose stop nginx || true", check=False)
 
@@ -157,19 +257,26 @@ def obtain_certificate(domain, email):
     log("Certificate request finished. If it failed, check above logs.")
 
     # basic check that cert directory exists
-    cert_dir = Path("/etc/letsencrypt/live") / domain
     if not cert_dir.exists():
         raise SystemExit("Certificate directory %s not found. certbot may have failed." % cert_dir)
     log("Cert directory looks good: %s" % cert_dir)
     return str(cert_dir)
 
 
+# nginx service -> its ports: block -> the "80:80" entry, matched in one pass
+# without leaving the nginx service (body lines are indented by 4+ spaces).
+NGINX_PORT80_RE = re.compile(
+    r'(^  nginx:\n(?:    .*\n)*?    ports:\n(?:      - "[^"]+"\n)*?      - "80:80")',
+    re.M,
+)
+
+
 def patch_docker_compose_for_443(compose_path="docker-compose.yml"):
     """
     Ensure nginx service has ports:
       - "80:80"
       - "443:443"
-    Simple string-based patch (we know the structure QuickAWS generates).
+    Simple regex patch (we know the structure QuickAWS generates).
     """
     p = Path(compose_path)
     if not p.exists():
@@ -177,42 +284,19 @@ def patch_docker_compose_for_443(compose_path="docker-compose.yml"):
 
     s = p.read_text()
 
-    # only patch if 443 not already present
-    if '  nginx:' not in s:
-        log("No nginx service found in docker-compose.yml, skipping 443 patch.")
-        return
-
+    # Idempotence gate: once patched, the file contains the 443 mapping and this
+    # single substring scan is all the work done (no regex, backup or write).
+    # A content hash or mtime cache would need extra state on disk to save the
+    # same one read of a ~1 KB file, so the content check is the cheaper gate.
     if '"443:443"' in s:
         log("443 mapping already present in docker-compose.yml, leaving as-is.")
         return
 
-    # find the ports block inside nginx
-    needle = '  nginx:\n'
-    idx = s.find(needle)
-    if idx == -1:
-        log("Could not find nginx block in docker-compose.yml, skipping 443 patch.")
-        return
-
-    # from nginx block, find "ports:" under it
-    nginx_block = s[idx:]
-    ports_idx = nginx_block.find("    ports:")
-    if ports_idx == -1:
-        log("nginx service has no ports: block, skipping 443 patch.")
-        return
-
-    # from ports: to next line after it
-    ports_start = idx + ports_idx
-    sub = s[ports_start:]
-    # look for the "80:80" line in that ports block
-    port80 = '      - "80:80"'
-    sub_idx = sub.find(port80)
-    if sub_idx == -1:
-        log("Could not find '80:80' line under nginx ports, skipping 443 patch.")
+    new_s, n = NGINX_PORT80_RE.subn(r'\1\n      - "443:443"', s, count=1)
+    if not n:
+        log("Could not find '80:80' under the nginx service ports, skipping 443 patch.")
         return
 
-    # insert 443 line after 80:80
-    insert_pos = ports_start + sub_idx + len(port80)
-    new_s = s[:insert_pos] + '\n      - "443:443"' + s[insert_pos:]
     backup = compose_path + ".bak_https"
     shutil.copy(p, backup)
     p.write_text(new_s)
@@ -10,6 +10,13 @@ import shutil
 import traceback
 import threading
 import itertools
+import functools
+import types
+import re
+import shlex
+import collections
+import tempfile
+import urllib.request
 from typing import Union
 from contextlib import contextmanager
 
@@ -21,7 +28,7 @@ LOGFILE = Path("provision.log")
 def log(msg: str):
     ts = time.strftime("%Y-%m-%d %H:%M:%S")
     line = f"{ts} {msg}"
-    print(line)
+    print(line, flush=True)
     try:
         with LOGFILE.open("a") as f:
             f.write(line + "\n")
@@ -29,23 +36,56 @@ def log(msg: str):
         pass
 
 
+# Commands containing any of these need /bin/sh (pipes, ||, $(...), redirects).
+SHELL_META = re.compile(r"[|&;<>()$`*?~]")
+
+
+def command_argv(cmd: str):
+    """Return an argv list for cmd, or None if it must go through the shell."""
+    if SHELL_META.search(cmd):
+        return None
+    try:
+        return shlex.split(cmd)
+    except ValueError:
+        # unbalanced quotes: let /bin/sh report it like it always did
+        return None
+
+
+def spawn(cmd: str, argv):
+    """Popen argv directly; names with no binary on PATH (shell builtins) fall back to /bin/sh."""
+    kwargs = dict(stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
+    if argv is not None:
+        try:
+            return subprocess.Popen(argv, **kwargs)
+        except FileNotFoundError:
+            pass
+    return subprocess.Popen(cmd, shell=True, **kwargs)
+
+
+def stream_command(cmd: str, emit):
+    """
+    Run cmd, passing each output line to emit() as it arrives.
+    Returns (returncode, last 200 lines of output).
+    """
+    argv = command_argv(cmd)
+    tail = collections.deque(maxlen=200)
+    p = spawn(cmd, argv)
+    with p.stdout:
+        for line in p.stdout:
+            emit(line.rstrip("\n"))
+            tail.append(line)
+    return p.wait(), "".join(tail)
+
+
 def run(cmd: str, check: bool = True):
+    """Run a command, streaming its output into the log as it arrives."""
     log(f"> {cmd}")
-    res = subprocess.run(
-        cmd,
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True,
-    )
-    if res.stdout:
-        for line in res.stdout.splitlines():
-            log("  " + line)
-    if check and res.returncode != 0:
+    returncode, out = stream_command(cmd, lambda line: log("  " + line))
+    if check and returncode != 0:
         raise RuntimeError(
-            f"Command failed ({res.returncode}): {cmd}\nOutput:\n{res.stdout}"
+            f"Command failed ({returncode}): {cmd}\nOutput:\n{out}"
         )
-    return res
+    return subprocess.CompletedProcess(cmd, returncode, stdout=out)
 
 
 def which(cmd: str):
@@ -96,37 +136,39 @@ def step(title: str):
 
 def run_with_spinner(cmd: str, label: str = "", check: bool = True):
     stop_event = threading.Event()
+    console = threading.Lock()
+    text = label or cmd
+    is_tty = sys.stdout.isatty()
 
     def spinner():
         chars = "|/-\\"
         it = itertools.cycle(chars)
-        text = label or cmd
         while not stop_event.is_set():
-            sys.stdout.write("\r" + text + " " + next(it))
-            sys.stdout.flush()
+            with console:
+                sys.stdout.write("\r" + text + " " + next(it))
+                sys.stdout.flush()
             time.sleep(0.15)
         sys.stdout.write("\r" + text + " ... done\n")
         sys.stdout.flush()
 
+    def emit(line: str):
+        # clear the spinner line so streamed output starts at column 0;
+        # no escape codes when stdout is a pipe (tee, CI logs)
+        with console:
+            if is_tty:
+                sys.stdout.write("\r\033[K")
+            log("  " + line)
+
     t = threading.Thread(target=spinner, daemon=True)
+    log(f"> {cmd}")
     t.start()
     try:
-        log(f"> {cmd}")
-        res = subprocess.run(
-            cmd,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-        )
-        if res.stdout:
-            for line in res.stdout.splitlines():
-                log("  " + line)
-        if check and res.returncode != 0:
+        returncode, out = stream_command(cmd, emit)
+        if check and returncode != 0:
             raise RuntimeError(
-                f"Command failed ({res.returncode}): {cmd}\nOutput:\n{res.stdout}"
+                f"Command failed ({returncode}): {cmd}\nOutput:\n{out}"
             )
-        return res
+        return subprocess.CompletedProcess(cmd, returncode, stdout=out)
     finally:
         stop_event.set()
         t.join()
@@ -134,19 +176,86 @@ def run_with_spinner(cmd: str, label: str = "", check: bool = True):
 
 # ---------- OS / Docker setup ----------
 
+@functools.lru_cache(maxsize=1)
 def detect_os_arch():
-    os_release = {}
-    if Path("/etc/os-release").exists():
-        for ln in open("/etc/os-release"):
-            ln = ln.strip()
-            if "=" in ln:
-                k, v = ln.split("=", 1)
-                os_release[k] = v.strip().strip('"')
+    """Parse /etc/os-release once per run; the result is read-only and shared."""
+    p = Path("/etc/os-release")
+    text = p.read_text() if p.exists() else ""
+    os_release = {
+        k.strip(): v.strip().strip('"')
+        for k, sep, v in (ln.partition("=") for ln in text.splitlines())
+        if sep and k.strip()
+    }
     distro = os_release.get("ID", "").lower()
     like = os_release.get("ID_LIKE", "").lower()
     version = os_release.get("VERSION_ID", "")
     arch = os.uname().machine
-    return {"distro": distro, "like": like, "version": version, "arch": arch, "os_release": os_release}
+    return types.MappingProxyType({
+        "distro": distro,
+        "like": like,
+        "version": version,
+        "arch": arch,
+        "os_release": types.MappingProxyType(os_release),
+    })
+
+
+APT_STAMP = Path("/var/lib/apt/periodic/update-success-stamp")
+
+
+def apt_update(max_age: int = 3600):
+    """apt-get update, skipped when the package lists were refreshed within max_age seconds."""
+    try:
+        if time.time() - APT_STAMP.stat().st_mtime < max_age:
+            log("apt package lists are fresh, skipping apt-get update")
+            return
+    except OSError:
+        pass
+    run("sudo apt-get update -y")
+
+
+DOCKER_APT_KEY_URL = "https://download.docker.com/linux/ubuntu/gpg"
+DOCKER_APT_KEYRING = "/etc/apt/keyrings/docker.asc"
+DOCKER_APT_LIST = "/etc/apt/sources.list.d/docker.list"
+
+
+def sudo_install_file(data: bytes, dest: str, mode: int = 0o644):
+    """Write data to a root-owned path: temp file, then `sudo install` into place."""
+    with tempfile.NamedTemporaryFile(delete=False) as tmp:
+        tmp.write(data)
+    try:
+        run(f"sudo install -D -m {mode:o} {tmp.name} {dest}")
+    finally:
+        os.unlink(tmp.name)
+
+
+def add_docker_apt_repo():
+    """
+    Add Docker's apt repository without curl/gpg/lsb_release: the armored key
+    is fetched with urllib and used as-is (apt accepts .asc keyrings), the
+    codename comes from /etc/os-release.
+    """
+    with urllib.request.urlopen(DOCKER_APT_KEY_URL, timeout=15) as resp:
+        key = resp.read()
+    sudo_install_file(key, DOCKER_APT_KEYRING)
+
+    os_release = detect_os_arch()["os_release"]
+    codename = os_release.get("UBUNTU_CODENAME") or os_release.get("VERSION_CODENAME")
+    if not codename:
+        raise RuntimeError("Could not determine distro codename from /etc/os-release.")
+    arch = run("dpkg --print-architecture").stdout.strip()
+    line = (
+        f"deb [arch={arch} signed-by={DOCKER_APT_KEYRING}] "
+        f"https://download.docker.com/linux/ubuntu {codename} stable\n"
+    )
+    sudo_install_file(line.encode(), DOCKER_APT_LIST)
+
+
+APT_DOCKER_PKGS = "ca-certificates docker-ce docker-ce-cli containerd.io docker-compose-plugin"
+
+# Installed in the same dnf/yum transaction as docker. Repos without a compose
+# plugin package just skip it (dnf strict=0, yum skip_missing_names_on_install)
+# and the standalone docker-compose download below covers that case.
+RPM_DOCKER_PKGS = "docker docker-compose-plugin"
 
 
 def ensure_docker_installed():
@@ -164,7 +273,7 @@ def ensure_docker_installed():
         try:
             if "amazon" in distro and version.startswith("2023"):
                 run("sudo dnf -y update")
-                run("sudo dnf -y install docker")
+                run(f"sudo dnf -y install --setopt=strict=0 {RPM_DOCKER_PKGS}")
                 run("sudo systemctl enable --now docker")
             elif "amzn" in distro or "amazon" in distro:
                 try:
@@ -172,32 +281,26 @@ def ensure_docker_installed():
                 except Exception:
                     log("amazon-linux-extras not available; continuing.")
                 run("sudo yum -y update")
-                run("sudo yum -y install -y docker || true")
+                run(f"sudo yum -y install {RPM_DOCKER_PKGS} || true")
                 run("sudo systemctl enable --now docker")
             elif any(x in distro for x in ("ubuntu", "debian", "raspbian", "pop")):
+                # key + source are written from Python, so no curl/gnupg/lsb-release
+                # is needed up front: one update, then one install transaction
+                add_docker_apt_repo()
                 run("sudo apt-get update -y")
-                run("sudo apt-get install -y ca-certificates curl gnupg lsb-release")
-                run("sudo mkdir -p /etc/apt/keyrings")
-                run("curl -fsSL https://download.docker.com/linux/ubuntu/gpg | sudo gpg --dearmor -o /etc/apt/keyrings/docker.gpg")
-                run(
-                    'echo "deb [arch=$(dpkg --print-architecture) signed-by=/etc/apt/keyrings/docker.gpg] '
-                    'https://download.docker.com/linux/ubuntu $(lsb_release -cs) stable" '
-                    '| sudo tee /etc/apt/sources.list.d/docker.list > /dev/null'
-                )
-                run("sudo apt-get update -y")
-                run("sudo apt-get install -y docker-ce docker-ce-cli containerd.io docker-compose-plugin")
+                run("sudo apt-get install -y " + APT_DOCKER_PKGS)
                 run("sudo systemctl enable --now docker")
             else:
                 if which("dnf"):
                     run("sudo dnf -y update")
-                    run("sudo dnf -y install docker || true")
+                    run(f"sudo dnf -y install --setopt=strict=0 {RPM_DOCKER_PKGS} || true")
                     run("sudo systemctl enable --now docker")
                 elif which("yum"):
                     run("sudo yum -y update")
-                    run("sudo yum -y install -y docker || true")
+                    run(f"sudo yum -y install {RPM_DOCKER_PKGS} || true")
                     run("sudo systemctl enable --now docker")
                 elif which("apt-get"):
-                    run("sudo apt-get update -y")
+                    apt_update()
                     run("sudo apt-get install -y docker.io || true")
                     run("sudo systemctl enable --now docker")
                 else: